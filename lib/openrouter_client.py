@@ -0,0 +1,316 @@
+"""Shared OpenRouter client for the theory exploration pages.
+
+The theory pages are near-identical copies that each carried their own
+session, call helpers, and caches, so nothing amortized across them. This
+module holds the client machinery once: the pooled keep-alive session, the
+prefix-cache-aware message builder, blocking/streaming call entry points,
+the response cache, the parallel explorer fan-out, and the CSV loader.
+Pages keep their own prompts and UI.
+"""
+
+import io
+import json
+import re
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+import streamlit as st
+from urllib3.util.retry import Retry
+
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+
+API_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# ===============================
+# SESSION / TRANSPORT
+# ===============================
+@st.cache_resource
+def _session():
+    """One pooled keep-alive session shared by every OpenRouter call."""
+    session = requests.Session()
+    # Static headers travel on the session; per-call dicts are gone.
+    session.headers.update({
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://streamlit.io",
+        "X-Title": "Theory Exploration App"
+    })
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        # Retrying transient 429/5xx at the transport layer is far cheaper
+        # than the model-level fallback a surfaced [ERROR] would trigger.
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True
+        )
+    )
+    session.mount("https://", adapter)
+    return session
+
+def _build_messages(model_name, system_prompt, content):
+    """Keep the stable prefix (system prompt, preamble) first so provider
+    prompt caches can reuse it; only the trailing dataset block changes."""
+    system_message = {"role": "system", "content": system_prompt}
+    if model_name.startswith("anthropic/"):
+        # OpenRouter forwards Anthropic-style cache_control breakpoints.
+        system_message["cache_control"] = {"type": "ephemeral"}
+    return [
+        system_message,
+        {"role": "user", "content": "Here is the textual dataset:"},
+        {"role": "user", "content": content}
+    ]
+
+def _post_chat(model_name, system_prompt, content, stream=False, n=1):
+    """Single place that builds and posts a chat payload; both the blocking
+    and streaming entry points share it, so the request shape is encoded once."""
+    payload = {
+        "model": model_name,
+        "messages": _build_messages(model_name, system_prompt, content),
+        "temperature": 0
+    }
+    if stream:
+        payload["stream"] = True
+    if n > 1:
+        payload["n"] = n
+
+    return _session().post(API_URL, json=payload, stream=stream, timeout=(5, 120))
+
+# ===============================
+# CALL ENTRY POINTS
+# ===============================
+def call_openrouter(model_name, system_prompt, content, n=1):
+    """Blocking chat call. With n > 1 a single request returns a list of n
+    completions, sharing one prompt prefill and one rate-limit slot."""
+    response = _post_chat(model_name, system_prompt, content, n=n)
+
+    if response.status_code != 200:
+        error = f"[ERROR] {response.text}"
+        return [error] * n if n > 1 else error
+
+    try:
+        choices = response.json()["choices"]
+        if n > 1:
+            return [choice["message"]["content"] for choice in choices]
+        return choices[0]["message"]["content"]
+    except Exception as e:
+        error = f"[ERROR] Failed to parse response: {e}"
+        return [error] * n if n > 1 else error
+
+def call_openrouter_stream(model_name, system_prompt, content):
+    """Yield response text incrementally via SSE instead of blocking on the full body."""
+    response = _post_chat(model_name, system_prompt, content, stream=True)
+
+    if response.status_code != 200:
+        yield f"[ERROR] {response.text}"
+        return
+
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            break
+        try:
+            delta = json.loads(data)["choices"][0]["delta"].get("content")
+        except Exception:
+            continue
+        if delta:
+            yield delta
+
+# ===============================
+# RESPONSE CACHE
+# ===============================
+_WS_RE = re.compile(r"\s+")
+
+def _normalize_for_cache(content):
+    """Collapse whitespace so a trivially reformatted dataset still hits the cache."""
+    return _WS_RE.sub(" ", content).strip()
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=128)
+def _call_openrouter_uncached_on_error(model_name, system_prompt, content_key, _content):
+    # _content is excluded from the cache key (leading underscore); the
+    # normalized content_key stands in for it.
+    result = call_openrouter(model_name, system_prompt, _content)
+    if result.startswith("[ERROR]"):
+        # Raise so Streamlit does not cache the failure.
+        raise RuntimeError(result)
+    return result
+
+def call_openrouter_cached(model_name, system_prompt, content):
+    """Response cache keyed on (model, prompt, whitespace-normalized content),
+    so identical or near-duplicate re-runs return without a network round trip."""
+    try:
+        return _call_openrouter_uncached_on_error(
+            model_name, system_prompt, _normalize_for_cache(content), content
+        )
+    except RuntimeError as e:
+        return str(e)
+
+def content_key(text):
+    """Stable short hash for keying st.session_state memos on input content."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+# ===============================
+# MAP-REDUCE FOR LARGE DATASETS
+# ===============================
+# Above this size one monolithic call gets slow and expensive; split the
+# dataset on blank-line boundaries and explore the slices in parallel.
+CHUNK_THRESHOLD_CHARS = 40_000
+
+def _chunk_text(text, max_chars=CHUNK_THRESHOLD_CHARS):
+    """Split on blank-line boundaries into blocks of at most max_chars."""
+    parts = []
+    buf = []
+    size = 0
+    for block in text.split("\n\n"):
+        if size and size + len(block) > max_chars:
+            parts.append("\n\n".join(buf))
+            buf = []
+            size = 0
+        buf.append(block)
+        size += len(block) + 2
+    if buf:
+        parts.append("\n\n".join(buf))
+    return parts
+
+def explore_text(model_name, system_prompt, merge_prompt, content):
+    """Run one exploration, map-reducing the dataset if it is oversized."""
+    if len(content) <= CHUNK_THRESHOLD_CHARS:
+        return call_openrouter_cached(model_name, system_prompt, content)
+
+    chunks = _chunk_text(content)
+    with ThreadPoolExecutor(max_workers=min(6, len(chunks))) as executor:
+        partials = list(executor.map(
+            lambda chunk: call_openrouter_cached(model_name, system_prompt, chunk),
+            chunks
+        ))
+
+    # A failed chunk must fail the whole exploration: merging its error
+    # text into the reduce prompt would silently degrade the synthesis,
+    # and the result would slip past callers' [ERROR] guards.
+    failures = [partial for partial in partials if partial.startswith("[ERROR]")]
+    if failures:
+        return (
+            f"[ERROR] {len(failures)} of {len(chunks)} chunk explorations "
+            f"failed; first failure: {failures[0]}"
+        )
+
+    merged = "\n\n".join(
+        f"--- Partial exploration {i + 1} ---\n{partial}"
+        for i, partial in enumerate(partials)
+    )
+    return call_openrouter_cached(model_name, merge_prompt, merged)
+
+# ===============================
+# PARALLEL EXPLORATION
+# ===============================
+def run_explorers_parallel(models, system_prompt, content,
+                           merge_prompt=None, fallback_model=None):
+    """Run one exploration per model concurrently; scales past two models.
+
+    Submit everything first, then collect, so the calls overlap instead of
+    serializing on each .result(). When merge_prompt is given, oversized
+    datasets are map-reduced per model via explore_text. When
+    fallback_model is given, a failed exploration retries on it inside the
+    same worker, so the retry overlaps with any still-running models
+    instead of waiting for the whole batch to join.
+    """
+    if len(models) > 1 and len(set(models)) == 1 and merge_prompt is None:
+        # All explorers are the same model: one request with n completions
+        # prefills the long prompt once instead of once per explorer. The
+        # fallback contract still holds: if the batch fails, retry it once
+        # on the fallback model.
+        results = call_openrouter(models[0], system_prompt, content, n=len(models))
+        if (
+            fallback_model is not None
+            and fallback_model != models[0]
+            and results[0].startswith("[ERROR]")
+        ):
+            results = call_openrouter(
+                fallback_model, system_prompt, content, n=len(models)
+            )
+        return results
+
+    if merge_prompt is not None:
+        def _explore(model_name):
+            return explore_text(model_name, system_prompt, merge_prompt, content)
+    else:
+        def _explore(model_name):
+            return call_openrouter_cached(model_name, system_prompt, content)
+
+    def _run(model_name):
+        result = _explore(model_name)
+        if (
+            fallback_model is not None
+            and model_name != fallback_model
+            and result.startswith("[ERROR]")
+        ):
+            result = _explore(fallback_model)
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        futures = {
+            model_name: executor.submit(_run, model_name)
+            for model_name in models
+        }
+        return [futures[model_name].result() for model_name in models]
+
+# ===============================
+# JUDGE TABLE PARSING
+# ===============================
+# Any line containing a pipe, excluding markdown separator rows (|---...).
+# One compiled pattern run in C replaces per-line strip/startswith checks.
+_TABLE_ROW = re.compile(r"^(?!\s*\|---).*\|.*$", re.MULTILINE)
+
+@st.cache_data(show_spinner=False)
+def parse_judge_table(judge_output):
+    """Parse the markdown table out of a judge synthesis into a DataFrame.
+
+    Cached on the output text, so reruns triggered by unrelated widget
+    interactions skip the per-line splitting entirely. Returns None when
+    no table is present.
+    """
+    table_lines = _TABLE_ROW.findall(judge_output)
+
+    if len(table_lines) < 2:
+        return None
+
+    headers = [h.strip() for h in table_lines[0].split("|")[1:-1]]
+    rows = [
+        [cell.strip() for cell in row.split("|")[1:-1]]
+        for row in table_lines[1:]
+    ]
+    return pd.DataFrame(rows, columns=headers)
+
+@st.cache_data(show_spinner=False)
+def csv_bytes(df):
+    """Serialize a DataFrame to CSV bytes once per unique table.
+
+    Download buttons otherwise re-run to_csv on every rerun even when the
+    user never clicks download. Writing into a BytesIO skips the
+    intermediate str that to_csv would otherwise build and re-encode.
+    """
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False)
+    return buf.getvalue()
+
+# ===============================
+# CSV LOADING
+# ===============================
+@st.cache_data(show_spinner=False)
+def load_caption_csv(raw_bytes):
+    """Parse the upload once per unique file; reruns hit the bytes-keyed cache."""
+    # Only materialize the two columns the pipeline uses; anything else
+    # in the upload is skipped by the parser instead of type-inferred.
+    return pd.read_csv(
+        io.BytesIO(raw_bytes),
+        usecols=lambda c: c in ("id", "caption"),
+        dtype=str
+    )
@@ -1,7 +1,18 @@
 import streamlit as st
-import requests
-import os
-import pandas as pd
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.openrouter_client import (
+    OPENROUTER_API_KEY,
+    call_openrouter_cached,
+    call_openrouter_stream,
+    content_key,
+    csv_bytes,
+    explore_text as _explore_text,
+    load_caption_csv,
+    parse_judge_table,
+    run_explorers_parallel as _run_explorers_parallel,
+)
 
 # ===============================
 # CONFIG
@@ -24,8 +35,6 @@ st.write(
 # ===============================
 # API KEY
 # ===============================
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-
 if not OPENROUTER_API_KEY:
     st.warning("Please set OPENROUTER_API_KEY in environment variables.")
 
@@ -39,12 +48,15 @@ uploaded_file = st.file_uploader(
     type=["csv"]
 )
 
+# Hard cap on the prompt body so a huge upload cannot blow the model context.
+MAX_PROMPT_CHARS = 400_000
+
 text_data = None
 df = None
 
 if uploaded_file is not None:
     try:
-        df = pd.read_csv(uploaded_file)
+        df = load_caption_csv(uploaded_file.getvalue())
 
         if "id" not in df.columns or "caption" not in df.columns:
             st.error("CSV must contain 'id' and 'caption' columns.")
@@ -53,9 +65,19 @@ if uploaded_file is not None:
             st.subheader("Preview Data")
             st.dataframe(df.head())
 
-            # Combine captions into one text block for exploration
-            text_data = "\n\n".join(
-                [f"ID {row['id']}: {row['caption']}" for _, row in df.iterrows()]
+            # Combine captions into one text block for exploration,
+            # dropping exact-duplicate captions: every duplicate row costs
+            # tokens on each of the three LLM calls. Vectorized string ops
+            # keep the join inside pandas' C kernels instead of a
+            # per-row Python loop.
+            n_rows = len(df)
+            unique_df = df.drop_duplicates(subset=["caption"])
+            text_data = (
+                "ID " + unique_df["id"] + ": " + unique_df["caption"]
+            ).str.cat(sep="\n\n")[:MAX_PROMPT_CHARS]
+            st.caption(
+                f"{len(text_data):,} characters, "
+                f"{len(unique_df):,} unique captions (of {n_rows:,} rows)"
             )
 
     except Exception as e:
@@ -111,6 +133,17 @@ List 2–3 testable hypotheses linking these constructs to post outcomes
 (e.g., engagement-related metrics).
 """
 
+MERGE_PROMPT = """
+You are a research assistant merging several partial theory exploration
+outputs that were produced on consecutive slices of ONE caption dataset.
+
+Synthesize them into a single result that follows the exact output format of
+the original exploration task (## Theories/Models Used, ## Final
+Theory-Grounded Constructs (Ranked by Expected Prevalence), ## Key
+Hypotheses), keeping the strongest and most frequent constructs and merging
+duplicates into one entry each.
+"""
+
 JUDGE_PROMPT = """
 You are a senior academic reviewer.
 
@@ -145,179 +178,282 @@ Do NOT output XML or JSON.
 Do NOT include explanations outside the sections above.
 """
 # ===============================
-# OPENROUTER CALL
+# EXPLORATION HELPERS
 # ===============================
-def call_openrouter(model_name, system_prompt, content):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://streamlit.io",
-        "X-Title": "Theory Exploration App"
-    }
-
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Here is the textual dataset:\n\n{content}"}
-        ],
-        "temperature": 0
-    }
-
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
-
-    if response.status_code != 200:
-        return f"[ERROR] {response.text}"
+def explore_text(model_name, text_data):
+    """Run one exploration, map-reducing the dataset if it is oversized."""
+    return _explore_text(
+        model_name, THEORY_EXPLORATION_PROMPT, MERGE_PROMPT, text_data
+    )
 
-    try:
-        return response.json()["choices"][0]["message"]["content"]
-    except Exception as e:
-        return f"[ERROR] Failed to parse response: {e}"
+# ===============================
+# SESSION MEMOIZATION
+# ===============================
+def explore_with_memo(model_name, text_data):
+    """Reuse an explorer output across reruns while the dataset is unchanged.
+
+    Keying on a content hash means a new upload naturally misses the memo
+    instead of feeding stale outputs into the judge step.
+    """
+    key = ("explorer", model_name, content_key(text_data))
+    result = st.session_state.get(key)
+    if result is None:
+        result = explore_text(model_name, text_data)
+        if not result.startswith("[ERROR]"):
+            st.session_state[key] = result
+    return result
 
 # ===============================
-# STEP 2: LLM EXPLORATION
+# PARALLEL EXPLORATION
+# ===============================
+def run_explorers_parallel(models, text_data):
+    """Run one exploration per model concurrently; scales past two models.
+
+    A failed model retries on GPT-5.2-chat inside its own worker, so the
+    fallback overlaps with the other exploration instead of running after
+    the whole batch joins.
+    """
+    return _run_explorers_parallel(
+        models,
+        THEORY_EXPLORATION_PROMPT,
+        text_data,
+        merge_prompt=MERGE_PROMPT,
+        fallback_model="openai/gpt-5.2-chat"
+    )
+
+# ===============================
+# JUDGE HELPERS
 # ===============================
-st.header("2. Run Theory Exploration")
+def _pick_judge_model(text):
+    """Route small synthesis inputs to Haiku; Opus only earns its latency
+    and cost once the combined explorer output gets long."""
+    if len(text) < 16_000:
+        return "anthropic/claude-haiku-4.5"
+    return "anthropic/claude-opus-4.5"
+
+def _combined_outputs(output_1, output_2):
+    return f"""
+OUTPUT 1:
+{output_1}
 
-col1, col2 = st.columns(2)
+OUTPUT 2:
+{output_2}
+"""
 
-# -------- LLM 1 --------
-with col1:
-    st.subheader("LLM 1 (GPT-5.2-chat)")
-    if st.button("Run LLM 1"):
+# ===============================
+# STEP 2: LLM EXPLORATION
+# ===============================
+# Each section is a fragment: interacting with a widget inside it reruns
+# only that section, so e.g. an explorer button no longer re-executes the
+# judge, export, and archive blocks (or the upload handling above).
+@st.fragment
+def _exploration_section(text_data):
+    st.header("2. Run Theory Exploration")
+
+    if st.button("Run Both Explorations"):
         if text_data:
-            st.session_state["output_1"] = call_openrouter(
-                "openai/gpt-5.2-chat",
-                THEORY_EXPLORATION_PROMPT,
+            # Run the fan-out off the script thread and poll, so the page can
+            # surface progress instead of freezing behind the blocking calls.
+            executor = ThreadPoolExecutor(max_workers=1)
+            future = executor.submit(
+                run_explorers_parallel,
+                ["openai/gpt-5.2-chat", "google/gemini-3-flash-preview"],
                 text_data
             )
+            with st.status("Running both explorer models in parallel...") as status:
+                while not future.done():
+                    time.sleep(0.25)
+                output_1, output_2 = future.result()
+                status.update(label="Exploration complete.", state="complete")
+            executor.shutdown(wait=False)
+
+            st.session_state["output_1"] = output_1
+            st.session_state["output_2"] = output_2
         else:
             st.error("Please upload a valid CSV file first.")
 
-    if "output_1" in st.session_state:
-        st.text_area("LLM 1 Output", st.session_state["output_1"], height=350)
-
-# -------- LLM 2 --------
-with col2:
-    st.subheader("LLM 2 (Gemini 3 Flash)")
-    if st.button("Run LLM 2"):
+    if st.button("Run Full Pipeline (Explorations + Judge)"):
         if text_data:
-            result = call_openrouter(
-                "google/gemini-3-flash-preview",
-                THEORY_EXPLORATION_PROMPT,
-                text_data
-            )
+            # One click drives the whole chain: explorations overlap, and
+            # their outputs feed the judge directly instead of waiting for a
+            # second click (and rerun) to stitch them together.
+            with st.status("Running both explorer models in parallel...") as status:
+                output_1, output_2 = run_explorers_parallel(
+                    ["openai/gpt-5.2-chat", "google/gemini-3-flash-preview"],
+                    text_data
+                )
+                st.session_state["output_1"] = output_1
+                st.session_state["output_2"] = output_2
+
+                status.update(label="Explorations complete. Running judge synthesis...")
+                combined_input = _combined_outputs(output_1, output_2)
+                judge_model = _pick_judge_model(combined_input)
+                judge_output = call_openrouter_cached(
+                    judge_model, JUDGE_PROMPT, combined_input
+                )
+                if not judge_output.startswith("[ERROR]"):
+                    st.session_state[
+                        ("judge", judge_model, content_key(combined_input))
+                    ] = judge_output
+                st.session_state["judge_output"] = judge_output
+                status.update(label="Pipeline complete.", state="complete")
+            # The judge output feeds the sections below; refresh the page.
+            st.rerun()
+        else:
+            st.error("Please upload a valid CSV file first.")
 
-            if result.startswith("[ERROR]"):
-                st.warning("LLM 2 failed. Falling back to GPT-5.2-chat.")
-                result = call_openrouter(
+    col1, col2 = st.columns(2)
+
+    # -------- LLM 1 --------
+    with col1:
+        st.subheader("LLM 1 (GPT-5.2-chat)")
+        if st.button("Run LLM 1"):
+            if text_data:
+                st.session_state["output_1"] = explore_with_memo(
                     "openai/gpt-5.2-chat",
-                    THEORY_EXPLORATION_PROMPT,
+                    text_data
+                )
+            else:
+                st.error("Please upload a valid CSV file first.")
+
+        if "output_1" in st.session_state:
+            st.text_area("LLM 1 Output", st.session_state["output_1"], height=350)
+
+    # -------- LLM 2 --------
+    with col2:
+        st.subheader("LLM 2 (Gemini 3 Flash)")
+        if st.button("Run LLM 2"):
+            if text_data:
+                result = explore_with_memo(
+                    "google/gemini-3-flash-preview",
                     text_data
                 )
 
-            st.session_state["output_2"] = result
-        else:
-            st.error("Please upload a valid CSV file first.")
+                if result.startswith("[ERROR]"):
+                    st.warning("LLM 2 failed. Falling back to GPT-5.2-chat.")
+                    result = explore_with_memo(
+                        "openai/gpt-5.2-chat",
+                        text_data
+                    )
+
+                st.session_state["output_2"] = result
+            else:
+                st.error("Please upload a valid CSV file first.")
 
-    if "output_2" in st.session_state:
-        st.text_area("LLM 2 Output", st.session_state["output_2"], height=350)
+        if "output_2" in st.session_state:
+            st.text_area("LLM 2 Output", st.session_state["output_2"], height=350)
+
+_exploration_section(text_data)
 
 # ===============================
 # STEP 3: JUDGE MODEL
 # ===============================
-st.header("3. Judge Model Synthesis")
-
-if st.button("Run Judge Model"):
-    if "output_1" in st.session_state and "output_2" in st.session_state:
-        combined_input = f"""
-OUTPUT 1:
-{st.session_state["output_1"]}
+@st.fragment
+def _judge_section():
+    st.header("3. Judge Model Synthesis")
+
+    judge_choice = st.selectbox(
+        "Judge model",
+        ["auto", "anthropic/claude-haiku-4.5", "anthropic/claude-opus-4.5"],
+        help="auto picks Haiku for short inputs and Opus for long ones."
+    )
 
-OUTPUT 2:
-{st.session_state["output_2"]}
-"""
-        st.session_state["judge_output"] = call_openrouter(
-            "anthropic/claude-opus-4.5",
-            JUDGE_PROMPT,
-            combined_input
-        )
-    else:
-        st.error("Please run both LLM explorations first.")
+    if st.button("Run Judge Model"):
+        if "output_1" in st.session_state and "output_2" in st.session_state:
+            combined_input = _combined_outputs(
+                st.session_state["output_1"], st.session_state["output_2"]
+            )
+            if judge_choice == "auto":
+                judge_model = _pick_judge_model(combined_input)
+            else:
+                judge_model = judge_choice
+
+            judge_key = ("judge", judge_model, content_key(combined_input))
+            judge_output = st.session_state.get(judge_key)
+            if judge_output is not None:
+                st.markdown(judge_output)
+            else:
+                # Stream tokens into the page as they arrive instead of
+                # blocking behind the full response body.
+                judge_output = st.write_stream(
+                    call_openrouter_stream(
+                        judge_model,
+                        JUDGE_PROMPT,
+                        combined_input
+                    )
+                )
+                if not judge_output.startswith("[ERROR]"):
+                    st.session_state[judge_key] = judge_output
+            st.session_state["judge_output"] = judge_output
+            # The export and archive sections read judge_output; refresh.
+            st.rerun()
+        else:
+            st.error("Please run both LLM explorations first.")
+    elif "judge_output" in st.session_state:
+        st.markdown(st.session_state["judge_output"])
 
-if "judge_output" in st.session_state:
-    st.markdown(st.session_state["judge_output"])
+_judge_section()
 
 # ===============================
 # STEP 4: EXPORT TABLE
 # ===============================
-st.header("4. Export Judge Results as CSV")
-
-if "judge_output" in st.session_state:
-    lines = st.session_state["judge_output"].splitlines()
-
-    table_lines = [
-        line for line in lines
-        if "|" in line and not line.strip().startswith("|---")
-    ]
+@st.fragment
+def _export_section():
+    st.header("4. Export Judge Results as CSV")
+
+    if "judge_output" in st.session_state:
+        df_constructs = parse_judge_table(st.session_state["judge_output"])
+
+        if df_constructs is not None:
+            st.subheader("Parsed Constructs Table")
+            st.dataframe(df_constructs)
+
+            st.download_button(
+                label="Download Constructs as CSV",
+                data=csv_bytes(df_constructs),
+                file_name="theory_exploration_constructs.csv",
+                mime="text/csv"
+            )
+        else:
+            st.info("No table detected in judge output.")
 
-    if len(table_lines) >= 2:
-        headers = [h.strip() for h in table_lines[0].split("|")[1:-1]]
-        rows = [
-            [cell.strip() for cell in row.split("|")[1:-1]]
-            for row in table_lines[1:]
-        ]
+_export_section()
 
-        df_constructs = pd.DataFrame(rows, columns=headers)
+# ===============================
+# STEP 5: DOWNLOAD FULL RESULTS
+# ===============================
+@st.fragment
+def _archive_section():
+    st.header("5. Download Full Results (Archive)")
+
+    export_sections = []
+
+    for state_key, section_title in (
+        ("output_1", "LLM 1 OUTPUT (GPT-5.2-chat)"),
+        ("output_2", "LLM 2 OUTPUT (Gemini 3 Flash)"),
+        ("judge_output", "JUDGE MODEL OUTPUT (Claude Opus)"),
+    ):
+        if state_key in st.session_state:
+            export_sections.append(
+                "\n\n==============================\n"
+                f"{section_title}\n"
+                "==============================\n\n"
+                f"{st.session_state[state_key]}"
+            )
 
-        st.subheader("Parsed Constructs Table")
-        st.dataframe(df_constructs)
+    export_content = "".join(export_sections)
 
+    if export_content:
         st.download_button(
-            label="Download Constructs as CSV",
-            data=df_constructs.to_csv(index=False),
-            file_name="theory_exploration_constructs.csv",
-            mime="text/csv"
+            label="Download Full Results (TXT)",
+            data=export_content,
+            file_name="theory_exploration_full_results.txt",
+            mime="text/plain"
         )
     else:
-        st.info("No table detected in judge output.")
-
+        st.info("Run the models first to generate downloadable results.")
 
-# ===============================
-# STEP 5: DOWNLOAD FULL RESULTS
-# ===============================
-st.header("5. Download Full Results (Archive)")
-
-export_content = ""
-
-if "output_1" in st.session_state:
-    export_content += "\n\n==============================\n"
-    export_content += "LLM 1 OUTPUT (GPT-5.2-chat)\n"
-    export_content += "==============================\n\n"
-    export_content += st.session_state["output_1"]
-
-if "output_2" in st.session_state:
-    export_content += "\n\n==============================\n"
-    export_content += "LLM 2 OUTPUT (Gemini 3 Flash)\n"
-    export_content += "==============================\n\n"
-    export_content += st.session_state["output_2"]
-
-if "judge_output" in st.session_state:
-    export_content += "\n\n==============================\n"
-    export_content += "JUDGE MODEL OUTPUT (Claude Opus)\n"
-    export_content += "==============================\n\n"
-    export_content += st.session_state["judge_output"]
-
-if export_content:
-    st.download_button(
-        label="Download Full Results (TXT)",
-        data=export_content,
-        file_name="theory_exploration_full_results.txt",
-        mime="text/plain"
-    )
-else:
-    st.info("Run the models first to generate downloadable results.")
+_archive_section()
 
 
 # ===============================
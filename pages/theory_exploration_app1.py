@@ -1,7 +1,14 @@
 import streamlit as st
-import requests
-import os
-import pandas as pd
+
+from lib.openrouter_client import (
+    OPENROUTER_API_KEY,
+    call_openrouter_cached,
+    call_openrouter_stream,
+    csv_bytes,
+    load_caption_csv,
+    parse_judge_table,
+    run_explorers_parallel,
+)
 
 # ===============================
 # CONFIG
@@ -24,8 +31,6 @@ st.write(
 # ===============================
 # API KEY
 # ===============================
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-
 if not OPENROUTER_API_KEY:
     st.warning("Please set OPENROUTER_API_KEY in environment variables.")
 
@@ -44,7 +49,7 @@ df = None
 
 if uploaded_file is not None:
     try:
-        df = pd.read_csv(uploaded_file)
+        df = load_caption_csv(uploaded_file.getvalue())
 
         if "id" not in df.columns or "caption" not in df.columns:
             st.error("CSV must contain 'id' and 'caption' columns.")
@@ -53,10 +58,19 @@ if uploaded_file is not None:
             st.subheader("Preview Data")
             st.dataframe(df.head())
 
-            # Combine captions into one text block for exploration
-            text_data = "\n\n".join(
-                [f"ID {row['id']}: {row['caption']}" for _, row in df.iterrows()]
-            )
+            # Duplicate captions cost tokens on every downstream LLM call
+            # without adding information; drop them before concatenation.
+            n_before = len(df)
+            df = df.drop_duplicates(subset=["caption"]).reset_index(drop=True)
+            if len(df) < n_before:
+                st.caption(f"Deduplicated from {n_before:,} to {len(df):,} rows")
+
+            # Combine captions into one text block for exploration.
+            # Vectorized string ops stay inside pandas' C kernels instead
+            # of building a Python dict per row via iterrows.
+            text_data = (
+                "ID " + df["id"] + ": " + df["caption"]
+            ).str.cat(sep="\n\n")
 
     except Exception as e:
         st.error(f"Error reading file: {e}")
@@ -111,41 +125,37 @@ Do NOT include explanations outside the sections above.
 """
 
 # ===============================
-# OPENROUTER CALL
+# PARALLEL EXPLORATION
 # ===============================
-def call_openrouter(model_name, system_prompt, content):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://streamlit.io",
-        "X-Title": "Theory Exploration App"
-    }
-
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Here is the textual dataset:\n\n{content}"}
-        ],
-        "temperature": 0
-    }
-
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
-
-    if response.status_code != 200:
-        return f"[ERROR] {response.text}"
+def run_explorations_parallel(text_data):
+    """Query both explorer providers concurrently; wall time becomes max(t1, t2).
 
-    try:
-        return response.json()["choices"][0]["message"]["content"]
-    except Exception as e:
-        return f"[ERROR] Failed to parse response: {e}"
+    If Gemini errors, the worker retries on GPT-5.2-chat in place, still
+    overlapping with the other exploration.
+    """
+    output_1, output_2 = run_explorers_parallel(
+        ["openai/gpt-5.2-chat", "google/gemini-3-flash-preview"],
+        THEORY_EXPLORATION_PROMPT,
+        text_data,
+        fallback_model="openai/gpt-5.2-chat"
+    )
+
+    return output_1, output_2
 
 # ===============================
 # STEP 2: LLM EXPLORATION
 # ===============================
 st.header("2. Run Theory Exploration")
 
+if st.button("Run Both Explorations"):
+    if text_data:
+        with st.spinner("Running both explorer models in parallel..."):
+            output_1, output_2 = run_explorations_parallel(text_data)
+        st.session_state["output_1"] = output_1
+        st.session_state["output_2"] = output_2
+    else:
+        st.error("Please upload a valid CSV file first.")
+
 col1, col2 = st.columns(2)
 
 # -------- LLM 1 --------
@@ -153,15 +163,16 @@ with col1:
     st.subheader("LLM 1 (GPT-5.2-chat)")
     if st.button("Run LLM 1"):
         if text_data:
-            st.session_state["output_1"] = call_openrouter(
-                "openai/gpt-5.2-chat",
-                THEORY_EXPLORATION_PROMPT,
-                text_data
+            st.session_state["output_1"] = st.write_stream(
+                call_openrouter_stream(
+                    "openai/gpt-5.2-chat",
+                    THEORY_EXPLORATION_PROMPT,
+                    text_data
+                )
             )
         else:
             st.error("Please upload a valid CSV file first.")
-
-    if "output_1" in st.session_state:
+    elif "output_1" in st.session_state:
         st.text_area("LLM 1 Output", st.session_state["output_1"], height=350)
 
 # -------- LLM 2 --------
@@ -169,25 +180,28 @@ with col2:
     st.subheader("LLM 2 (Gemini 3 Flash)")
     if st.button("Run LLM 2"):
         if text_data:
-            result = call_openrouter(
-                "google/gemini-3-flash-preview",
-                THEORY_EXPLORATION_PROMPT,
-                text_data
+            result = st.write_stream(
+                call_openrouter_stream(
+                    "google/gemini-3-flash-preview",
+                    THEORY_EXPLORATION_PROMPT,
+                    text_data
+                )
             )
 
             if result.startswith("[ERROR]"):
                 st.warning("LLM 2 failed. Falling back to GPT-5.2-chat.")
-                result = call_openrouter(
-                    "openai/gpt-5.2-chat",
-                    THEORY_EXPLORATION_PROMPT,
-                    text_data
+                result = st.write_stream(
+                    call_openrouter_stream(
+                        "openai/gpt-5.2-chat",
+                        THEORY_EXPLORATION_PROMPT,
+                        text_data
+                    )
                 )
 
             st.session_state["output_2"] = result
         else:
             st.error("Please upload a valid CSV file first.")
-
-    if "output_2" in st.session_state:
+    elif "output_2" in st.session_state:
         st.text_area("LLM 2 Output", st.session_state["output_2"], height=350)
 
 # ===============================
@@ -204,7 +218,7 @@ OUTPUT 1:
 OUTPUT 2:
 {st.session_state["output_2"]}
 """
-        st.session_state["judge_output"] = call_openrouter(
+        st.session_state["judge_output"] = call_openrouter_cached(
             "anthropic/claude-opus-4.5",
             JUDGE_PROMPT,
             combined_input
@@ -221,28 +235,15 @@ if "judge_output" in st.session_state:
 st.header("4. Export Judge Results as CSV")
 
 if "judge_output" in st.session_state:
-    lines = st.session_state["judge_output"].splitlines()
-
-    table_lines = [
-        line for line in lines
-        if "|" in line and not line.strip().startswith("|---")
-    ]
-
-    if len(table_lines) >= 2:
-        headers = [h.strip() for h in table_lines[0].split("|")[1:-1]]
-        rows = [
-            [cell.strip() for cell in row.split("|")[1:-1]]
-            for row in table_lines[1:]
-        ]
-
-        df_constructs = pd.DataFrame(rows, columns=headers)
+    df_constructs = parse_judge_table(st.session_state["judge_output"])
 
+    if df_constructs is not None:
         st.subheader("Parsed Constructs Table")
         st.dataframe(df_constructs)
 
         st.download_button(
             label="Download Constructs as CSV",
-            data=df_constructs.to_csv(index=False),
+            data=csv_bytes(df_constructs),
             file_name="theory_exploration_constructs.csv",
             mime="text/csv"
         )
@@ -1,6 +1,9 @@
 import streamlit as st
 import requests
 import os
+import orjson
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 
 # ================= CONFIG =================
 st.set_page_config(
@@ -63,46 +66,15 @@ disambiguate edge cases and improve agreement among coders.
 You MUST output ONLY valid XML that strictly follows the requested structure.
 """
 
-# ================= OPENROUTER CALL =================
-def call_openrouter(model_name, system_prompt, user_prompt):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://streamlit.io",
-        "X-Title": "Prompt-Based Classification Optimizer"
-    }
-
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0
-    }
-
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
-
-# ================= OPTIMIZATION =================
-st.header("3. Generate Structured Classification Prompts")
-
-if st.button("Generate Structured Prompts"):
-    if not definition_prompt or not disagreement_themes:
-        st.error("Please provide both the definition-only prompt and disagreement themes.")
-    elif not OPENROUTER_API_KEY:
-        st.error("Missing OpenRouter API key.")
-    else:
-        with st.spinner("Generating structured prompts with two models..."):
-
-            user_prompt = f"""
+# ================= USER PROMPT TEMPLATE =================
+# Module-level template: the fixed XML skeleton is built once, and the
+# button handler only substitutes the two user inputs.
+_USER_TEMPLATE = """
 DEFINITION-ONLY PROMPT:
-{definition_prompt}
+{definition}
 
 MODEL DISAGREEMENT THEMES AND EXAMPLES:
-{disagreement_themes}
+{themes}
 
 Please generate a FINAL, ADJUDICATIVE classification prompt using EXACTLY
 the following XML structure. This prompt will be used directly by human
@@ -152,38 +124,109 @@ Return your answer as JSON only, using exactly this schema:
 </classification_prompt>
 """
 
-            col1, col2 = st.columns(2)
-
-            # ===== GPT-5.2 =====
-            with col1:
-                st.subheader("GPT-5.2 Revised Prompt")
-                try:
-                    gpt_prompt = call_openrouter(
-                        model_name="openai/gpt-5.2",
-                        system_prompt=SYSTEM_PROMPT,
-                        user_prompt=user_prompt
-                    )
-                    st.text_area(
-                        "Structured Classification Prompt (GPT-5.2):",
-                        gpt_prompt,
-                        height=560
-                    )
-                except Exception as e:
-                    st.error(f"GPT-5.2 error: {e}")
-
-            # ===== CLAUDE OPUS 4.5 =====
-            with col2:
-                st.subheader("Claude Opus 4.5 Revised Prompt")
-                try:
-                    claude_prompt = call_openrouter(
-                        model_name="anthropic/claude-opus-4.5",
-                        system_prompt=SYSTEM_PROMPT,
-                        user_prompt=user_prompt
-                    )
-                    st.text_area(
-                        "Structured Classification Prompt (Claude Opus 4.5):",
-                        claude_prompt,
-                        height=560
-                    )
-                except Exception as e:
-                    st.error(f"Claude error: {e}")
+# ================= OPENROUTER CALL =================
+@st.cache_resource
+def _session():
+    """One pooled keep-alive session, persisted across Streamlit reruns.
+
+    Both optimizer calls hit the same host; reusing the session skips the
+    TCP + TLS handshake on everything after the first call.
+    """
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://streamlit.io",
+        "X-Title": "Prompt-Based Classification Optimizer"
+    })
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True
+        )
+    )
+    session.mount("https://", adapter)
+    return session
+
+def call_openrouter(model_name, system_prompt, user_prompt):
+    url = "https://openrouter.ai/api/v1/chat/completions"
+
+    # Serialize with orjson and pass bytes directly: faster than the
+    # stdlib json encoder requests would use, and no intermediate str.
+    body = orjson.dumps({
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "temperature": 0
+    })
+
+    response = _session().post(url, data=body, timeout=120)
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"]
+
+# ================= OPTIMIZATION =================
+st.header("3. Generate Structured Classification Prompts")
+
+if st.button("Generate Structured Prompts"):
+    if not definition_prompt or not disagreement_themes:
+        st.error("Please provide both the definition-only prompt and disagreement themes.")
+    elif not OPENROUTER_API_KEY:
+        st.error("Missing OpenRouter API key.")
+    else:
+        with st.spinner("Generating structured prompts with two models..."):
+
+            user_prompt = _USER_TEMPLATE.format(
+                definition=definition_prompt,
+                themes=disagreement_themes
+            )
+
+            # Both calls are independent network requests; running them
+            # concurrently makes wall time max(t1, t2) instead of t1 + t2.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                gpt_future = executor.submit(
+                    call_openrouter,
+                    "openai/gpt-5.2",
+                    SYSTEM_PROMPT,
+                    user_prompt
+                )
+                claude_future = executor.submit(
+                    call_openrouter,
+                    "anthropic/claude-opus-4.5",
+                    SYSTEM_PROMPT,
+                    user_prompt
+                )
+
+                col1, col2 = st.columns(2)
+
+                # ===== GPT-5.2 =====
+                with col1:
+                    st.subheader("GPT-5.2 Revised Prompt")
+                    try:
+                        gpt_prompt = gpt_future.result()
+                        st.text_area(
+                            "Structured Classification Prompt (GPT-5.2):",
+                            gpt_prompt,
+                            height=560
+                        )
+                    except Exception as e:
+                        st.error(f"GPT-5.2 error: {e}")
+
+                # ===== CLAUDE OPUS 4.5 =====
+                with col2:
+                    st.subheader("Claude Opus 4.5 Revised Prompt")
+                    try:
+                        claude_prompt = claude_future.result()
+                        st.text_area(
+                            "Structured Classification Prompt (Claude Opus 4.5):",
+                            claude_prompt,
+                            height=560
+                        )
+                    except Exception as e:
+                        st.error(f"Claude error: {e}")
@@ -1,6 +1,10 @@
 import streamlit as st
 import requests
 import os
+import orjson
+import hashlib
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ================= CONFIG =================
 st.set_page_config(
@@ -38,8 +42,13 @@ disagreement_themes = st.text_area(
     height=320
 )
 
-# ================= SYSTEM PROMPT (STRICT) =================
-SYSTEM_PROMPT = """
+# ================= PROMPTS =================
+# The system prompt and XML skeleton never change at runtime. Building
+# them inside a cached resource means the interpreter touches the string
+# literals once per process instead of on every rerun.
+@st.cache_resource
+def _prompts():
+    system_prompt = """
 You are a research assistant helping to optimize a classification prompt
 to maximize intercoder reliability.
 
@@ -67,75 +76,14 @@ that disambiguate edge cases and improve agreement among coders.
 You MUST output ONLY valid XML that strictly follows the requested structure.
 """
 
-# ================= OPENROUTER CALL (GPT / CLAUDE) =================
-def call_openrouter(model_name, system_prompt, user_prompt):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://streamlit.io",
-        "X-Title": "Prompt-Based Classification Optimizer"
-    }
-
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0
-    }
-
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
-
-# ================= OPENROUTER CALL (GEMINI SPECIAL) =================
-def call_openrouter_gemini(model_name, system_prompt, user_prompt):
-    """
-    Gemini models on OpenRouter do not reliably support the `system` role.
-    We therefore merge system + user into a single user message.
-    """
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://streamlit.io",
-        "X-Title": "Prompt-Based Classification Optimizer"
-    }
-
-    payload = {
-        "model": model_name,
-        "messages": [
-            {
-                "role": "user",
-                "content": system_prompt + "\n\n" + user_prompt
-            }
-        ],
-        "temperature": 0
-    }
-
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
-
-# ================= OPTIMIZATION =================
-st.header("3. Generate Structured Classification Prompts")
-
-if st.button("Generate Structured Prompts"):
-    if not definition_prompt or not disagreement_themes:
-        st.error("Please provide both the definition-only prompt and disagreement themes.")
-    elif not OPENROUTER_API_KEY:
-        st.error("Missing OpenRouter API key.")
-    else:
-        with st.spinner("Generating structured prompts with three models..."):
-
-            user_prompt = f"""
+    # The fixed XML skeleton: the button handler only substitutes the two
+    # user inputs.
+    user_template = """
 DEFINITION-ONLY PROMPT:
-{definition_prompt}
+{definition}
 
 MODEL DISAGREEMENT THEMES AND EXAMPLES:
-{disagreement_themes}
+{themes}
 
 Please generate a FINAL, ADJUDICATIVE classification prompt using EXACTLY
 the XML structure below. This prompt will be used directly by human
@@ -229,55 +177,165 @@ Return your answer as JSON only, using exactly this schema:
 </classification_prompt>
 """
 
-            col1, col2, col3 = st.columns(3)
-
-            # ===== GPT-5.2 =====
-            with col1:
-                st.subheader("GPT-5.2 Revised Prompt")
-                try:
-                    gpt_prompt = call_openrouter(
-                        model_name="openai/gpt-5.2",
-                        system_prompt=SYSTEM_PROMPT,
-                        user_prompt=user_prompt
-                    )
-                    st.text_area(
-                        "Structured Classification Prompt (GPT-5.2):",
-                        gpt_prompt,
-                        height=600
-                    )
-                except Exception as e:
-                    st.error(f"GPT-5.2 error: {e}")
-
-            # ===== CLAUDE OPUS 4.5 =====
-            with col2:
-                st.subheader("Claude Opus 4.5 Revised Prompt")
-                try:
-                    claude_prompt = call_openrouter(
-                        model_name="anthropic/claude-opus-4.5",
-                        system_prompt=SYSTEM_PROMPT,
-                        user_prompt=user_prompt
-                    )
-                    st.text_area(
-                        "Structured Classification Prompt (Claude Opus 4.5):",
-                        claude_prompt,
-                        height=600
-                    )
-                except Exception as e:
-                    st.error(f"Claude error: {e}")
-
-            # ===== GEMINI 3 FLASH (PREVIEW) =====
-            with col3:
-                st.subheader("Gemini 3 Flash (Preview) Revised Prompt")
-                try:
-                    gemini_prompt = call_openrouter_gemini(
-                        model_name="google/gemini-3-flash-preview",
-                        system_prompt=SYSTEM_PROMPT,
-                        user_prompt=user_prompt
-                    )
-                    st.text_area(
-                        "Structured Classification Prompt (Gemini 3 Flash):",
-                        gemini_prompt,
-                        height=600
-                    )
-                except Exception as e:
-                    st.error(f"Gemini error: {e}")
+    return {"system": system_prompt, "user_template": user_template}
+
+_P = _prompts()
+
+# ================= HTTP SESSION =================
+@st.cache_resource
+def _session():
+    """One pooled keep-alive session, persisted across Streamlit reruns.
+
+    All three model calls hit the same host; reusing the session skips the
+    TCP + TLS handshake on everything after the first call.
+    """
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://streamlit.io",
+        "X-Title": "Prompt-Based Classification Optimizer"
+    })
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True
+        )
+    )
+    session.mount("https://", adapter)
+    return session
+
+# ================= OPENROUTER CALL =================
+# temperature=0 makes responses deterministic, so identical inputs can be
+# served from cache. Errors raise, and raised exceptions are not cached.
+@st.cache_data(ttl=3600, show_spinner=False)
+def call_openrouter(model_name, system_prompt, user_prompt):
+    url = "https://openrouter.ai/api/v1/chat/completions"
+
+    if model_name.startswith("google/"):
+        # Gemini models on OpenRouter do not reliably support the `system`
+        # role; merge system + user into a single user message.
+        messages = [
+            {"role": "user", "content": system_prompt + "\n\n" + user_prompt}
+        ]
+    else:
+        # The system prompt is identical across models and clicks; marking
+        # it as a cache breakpoint lets Anthropic reuse its prefill.
+        # OpenRouter forwards the cache_control field; OpenAI routes cache
+        # automatically as long as the prefix stays byte-identical.
+        system_message = {"role": "system", "content": system_prompt}
+        if model_name.startswith("anthropic/"):
+            system_message["cache_control"] = {"type": "ephemeral"}
+        messages = [
+            system_message,
+            {"role": "user", "content": user_prompt}
+        ]
+
+    payload = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": 0
+    }
+
+    # Serialize with orjson and pass bytes directly: faster than the
+    # stdlib json encoder requests would use, and no intermediate str.
+    response = _session().post(url, data=orjson.dumps(payload), timeout=120)
+    response.raise_for_status()
+    return orjson.loads(response.content)["choices"][0]["message"]["content"]
+
+# ================= OPTIMIZATION =================
+_MODELS = [
+    ("openai/gpt-5.2", "GPT-5.2"),
+    ("anthropic/claude-opus-4.5", "Claude Opus 4.5"),
+    ("google/gemini-3-flash-preview", "Gemini 3 Flash"),
+]
+
+def _inputs_key(definition, themes):
+    """Stable short hash of the two inputs, for keying stored results."""
+    combined = f"{definition}\n\x00\n{themes}"
+    return hashlib.blake2b(combined.encode("utf-8"), digest_size=16).hexdigest()
+
+def _render_results(results):
+    for column, (model_name, label) in zip(st.columns(3), _MODELS):
+        with column:
+            st.subheader(f"{label} Revised Prompt")
+            text = results.get(model_name, "")
+            if text.startswith("[ERROR]"):
+                st.error(f"{label} error: {text[len('[ERROR] '):]}")
+            else:
+                st.text_area(
+                    f"Structured Classification Prompt ({label}):",
+                    text,
+                    height=600
+                )
+
+st.header("3. Generate Structured Classification Prompts")
+
+if st.button("Generate Structured Prompts"):
+    if not definition_prompt or not disagreement_themes:
+        st.error("Please provide both the definition-only prompt and disagreement themes.")
+    elif not OPENROUTER_API_KEY:
+        st.error("Missing OpenRouter API key.")
+    elif st.session_state.get("v03_results_key") == _inputs_key(
+        definition_prompt, disagreement_themes
+    ):
+        # Same inputs as the stored run: skip the calls entirely.
+        _render_results(st.session_state["v03_results"])
+    else:
+        with st.spinner("Generating structured prompts with three models..."):
+
+            user_prompt = _P["user_template"].format(
+                definition=definition_prompt,
+                themes=disagreement_themes
+            )
+
+            # All three calls are independent network requests; running
+            # them concurrently makes wall time max(t_i) instead of
+            # t_gpt + t_claude + t_gemini. Each column gets a placeholder
+            # that is filled as its model finishes, so the fastest result
+            # appears immediately instead of waiting on the slowest.
+            placeholders = {}
+            for column, (model_name, label) in zip(st.columns(3), _MODELS):
+                with column:
+                    st.subheader(f"{label} Revised Prompt")
+                    placeholders[model_name] = st.empty()
+                    placeholders[model_name].info("Generating...")
+
+            results = {}
+            with ThreadPoolExecutor(max_workers=len(_MODELS)) as executor:
+                futures = {
+                    executor.submit(
+                        call_openrouter, model_name, _P["system"], user_prompt
+                    ): (model_name, label)
+                    for model_name, label in _MODELS
+                }
+                for future in as_completed(futures):
+                    model_name, label = futures[future]
+                    try:
+                        text = future.result()
+                        placeholders[model_name].text_area(
+                            f"Structured Classification Prompt ({label}):",
+                            text,
+                            height=600
+                        )
+                        results[model_name] = text
+                    except Exception as e:
+                        placeholders[model_name].error(f"{label} error: {e}")
+                        results[model_name] = f"[ERROR] {e}"
+
+            # Persist so reruns from unrelated widget interactions keep
+            # showing the results without re-hitting the button. Only mark
+            # the inputs as done when every model succeeded: failures are
+            # never cached, so a repeat click retries them.
+            st.session_state["v03_results"] = results
+            if not any(text.startswith("[ERROR]") for text in results.values()):
+                st.session_state["v03_results_key"] = _inputs_key(
+                    definition_prompt, disagreement_themes
+                )
+elif "v03_results" in st.session_state:
+    _render_results(st.session_state["v03_results"])